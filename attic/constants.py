@@ -1,4 +1,7 @@
-class EntityType:
+from enum import Enum
+
+
+class EntityType(Enum):
     Account = 'Account'
     AccountHolder = 'AccountHolder'
     Company = 'Company'
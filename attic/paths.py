@@ -5,3 +5,4 @@ project_root = pathlib.Path(__file__).parent.parent
 
 path_data = project_root / "data/"
 path_plots = project_root / "plots/"
+path_cache = project_root / "cache/"
@@ -1,20 +1,25 @@
 
+import functools
 import warnings
 
-import matplotlib.patches as mpatches
-import matplotlib.pyplot as plt
 import networkx as nx
 import numpy as np
 import pandas as pd
+from sqlalchemy import func, or_
+from sqlalchemy.orm import aliased
 
 from attic import paths
 from attic.connection_settings import connectionSettings
 from attic.constants import EntityType
-from eutl_orm import Account, AccountHolder
+from eutl_orm import (Account, AccountHolder, AccountType, Transaction, TransactionTypeMain,
+                      TransactionTypeSupplementary, UnitType)
 from eutl_orm import DataAccessLayer
 
-dal = DataAccessLayer(**connectionSettings)
-session = dal.session
+
+@functools.lru_cache(maxsize=1)
+def get_session():
+    """Return the database session. The connection is only opened on first use, not when the module is imported."""
+    return DataAccessLayer(**connectionSettings).session
 
 
 def map_account_to_accountHolder() -> pd.DataFrame:
@@ -26,24 +31,100 @@ def map_account_to_accountHolder() -> pd.DataFrame:
     - the name of its account holder name (accountHolder_name)
 
     The DataFrame is used to map each account with its account holder. Since this mapping is independent of a
-    particular Entity under consideration, we define it at the module level. It is built when the module is imported.
+    particular Entity under consideration, we share it at the module level (see get_account_to_accountHolder).
+    """
+    session = get_session()
+    # inner join: accounts without account holder are left out
+    mapping_query = session.query(Account.id.label("account_id"), Account.accountHolder_id,
+                                  AccountHolder.name.label("accountHolder_name"))\
+        .join(AccountHolder, Account.accountHolder_id == AccountHolder.id)
+    mapping = pd.read_sql(mapping_query.statement, con=session.connection())
+    mapping = mapping.astype({"account_id": "Int64", "accountHolder_id": "Int64", "accountHolder_name": "category"})
+
+    return mapping
+
+
+def load_account_to_accountHolder() -> pd.DataFrame:
+    """Return the mapping between account and account holder, using the on-disk cache when it is up to date.
+
+    The mapping built by map_account_to_accountHolder is stored as a parquet file together with a token made of the
+    largest account id and the number of accounts in the database. As long as the token matches, the mapping is read
+    from disk instead of being rebuilt from the Account and AccountHolder tables.
     """
-    mapping_query = session.query(Account.id, Account.accountHolder_id)
-    mapping = pd.read_sql(mapping_query.statement, con=session.bind)
-    mapping.dropna(inplace=True)
-    mapping["accountHolder_id"] = mapping["accountHolder_id"].astype(int)
-    mapping.rename(columns={"id": "account_id"}, inplace=True)
+    session = get_session()
+    path_mapping = paths.path_cache / "account_to_accountHolder.parquet"
+    path_token = path_mapping.with_suffix(".meta")
+
+    max_account_id, n_accounts = session.query(func.max(Account.id), func.count(Account.id)).one()
+    token = f"{max_account_id},{n_accounts}"
 
-    # add accountHolder name
-    account_holder_id_to_name = pd.DataFrame(session.query(AccountHolder.id, AccountHolder.name).all())
-    account_holder_id_to_name.rename(columns={"id": "accountHolder_id", "name": "accountHolder_name"}, inplace=True)
-    mapping = mapping.merge(account_holder_id_to_name, on="accountHolder_id")
+    if path_mapping.exists() and path_token.exists() and path_token.read_text() == token:
+        return pd.read_parquet(path_mapping)
 
+    mapping = map_account_to_accountHolder()
+    paths.path_cache.mkdir(parents=True, exist_ok=True)
+    mapping.to_parquet(path_mapping, compression="zstd")
+    path_token.write_text(token)
     return mapping
 
 
-# map Account to AccountHolder (id and name)
-account_to_accountHolder = map_account_to_accountHolder()
+@functools.lru_cache(maxsize=1)
+def get_account_to_accountHolder() -> pd.DataFrame:
+    """Return the mapping of Account to AccountHolder (id and name), indexed by account id.
+
+    The mapping is loaded on first use and then kept for the lifetime of the process.
+    """
+    return load_account_to_accountHolder().set_index("account_id")
+
+
+@functools.lru_cache(maxsize=128)
+def query_transactions(account_ids: tuple, start=None, end=None) -> pd.DataFrame:
+    """Return the transactions involving any of the given accounts within the period [start, end].
+
+    All transactions are fetched in a single query. Results are cached by account ids and period bounds so that
+    successive EntityConnexion objects covering the same accounts do not hit the database again. The returned
+    DataFrame is shared between calls and must not be modified in place.
+    """
+    session = get_session()
+    transferringAccount = aliased(Account)
+    acquiringAccount = aliased(Account)
+    transferringAccountType = aliased(AccountType)
+    acquiringAccountType = aliased(AccountType)
+    transaction_query = session.query(
+        Transaction.date.label("datetime"), Transaction.amount,
+        Transaction.transferringAccount_id,
+        transferringAccount.name.label("transferringAccountName"),
+        transferringAccountType.description.label("transferringAccountType"),
+        Transaction.acquiringAccount_id,
+        acquiringAccount.name.label("acquiringAccountName"),
+        acquiringAccountType.description.label("acquiringAccountType"),
+        TransactionTypeMain.description.label("transactionTypeMain"),
+        TransactionTypeSupplementary.description.label("transactionTypeSupplementary"),
+        UnitType.description.label("unitType"))\
+        .outerjoin(transferringAccount, Transaction.transferringAccount_id == transferringAccount.id)\
+        .outerjoin(transferringAccountType, transferringAccount.accountType_id == transferringAccountType.id)\
+        .outerjoin(acquiringAccount, Transaction.acquiringAccount_id == acquiringAccount.id)\
+        .outerjoin(acquiringAccountType, acquiringAccount.accountType_id == acquiringAccountType.id)\
+        .outerjoin(TransactionTypeMain, Transaction.transactionTypeMain_id == TransactionTypeMain.id)\
+        .outerjoin(TransactionTypeSupplementary,
+                   Transaction.transactionTypeSupplementary_id == TransactionTypeSupplementary.id)\
+        .outerjoin(UnitType, Transaction.unitType_id == UnitType.id)\
+        .filter(or_(Transaction.transferringAccount_id.in_(account_ids),
+                    Transaction.acquiringAccount_id.in_(account_ids)))
+    # restrict to the considered period (bounds set to None are left open)
+    if start is not None:
+        transaction_query = transaction_query.filter(Transaction.date >= start)
+    if end is not None:
+        transaction_query = transaction_query.filter(Transaction.date <= end)
+    transaction_query = transaction_query.order_by(Transaction.date)
+    # nullable integers keep the account ids integer even when one side of a transaction is missing
+    dtypes = {'transferringAccount_id': "Int64", 'acquiringAccount_id': "Int64"}
+    dtypes.update({column: "category" for column in [
+        'transferringAccountName', 'transferringAccountType', 'acquiringAccountName', 'acquiringAccountType',
+        'transactionTypeMain', 'transactionTypeSupplementary', 'unitType']})
+    transactions = pd.read_sql_query(transaction_query.statement, con=session.connection(),
+                                     parse_dates=['datetime'], dtype=dtypes)
+    return transactions
 
 
 class EntityConnexion:
@@ -53,11 +134,11 @@ class EntityConnexion:
 
     def __init__(self, entity_type, entity_id, period=(None, None)):
         """Instantiate EntityConnexion object for the considered entity."""
-        if entity_type not in [EntityType.Account, EntityType.AccountHolder, EntityType.Company]:
+        try:
+            self.entity_type = EntityType(entity_type)
+        except ValueError:
             raise ValueError(f'entity_type needs to be one of Account, Company or AccountHolder. '
                              f'Your input: {entity_type}')
-        else:
-            self.entity_type = entity_type
 
         self.entity_id = entity_id
         self.period = period
@@ -68,74 +149,60 @@ class EntityConnexion:
     def build_transaction_graph(self, keep_interactive_plot=False):
         """Build and plot the transaction graph for the considered entity."""
         self.get_accounts()
+        if not self.accounts:  # nothing to query nor plot
+            return
         self.get_transactions()
         self.plot_arrows(keep_interactive_plot)
 
     def get_accounts(self):
         """Look up and return the list of accounts related to the considered Entity."""
 
-        if self.entity_type == EntityType.Account:
+        session = get_session()
+        if self.entity_type is EntityType.Account:
             self.accounts = session.query(Account).filter(Account.id == self.entity_id).all()
             self.entity_name = self.accounts[0].name
-        elif self.entity_type == EntityType.AccountHolder:
+        elif self.entity_type is EntityType.AccountHolder:
             self.accounts = session.query(Account).filter(Account.accountHolder_id == self.entity_id).all()
             self.entity_name = session.query(AccountHolder).filter(AccountHolder.id == self.entity_id).first().name
-        elif self.entity_type == EntityType.Company:
+        elif self.entity_type is EntityType.Company:
             self.accounts = session.query(Account).filter(Account.companyRegistrationNumber == self.entity_id).all()
             self.entity_name = ''
 
-        print(f'You are investigating {self.entity_type} number {self.entity_id} '
+        print(f'You are investigating {self.entity_type.value} number {self.entity_id} '
               f'(name: {self.entity_name}) - {len(self.accounts)} related accounts')
 
     def get_transactions(self):
         """Get list of transaction involving each Account assigned to the Entity."""
 
-        transaction_tables = []
-        for account in self.accounts:
-            transaction_tables.append(account.get_transactions())
-
-        if len(transaction_tables) == 1 and transaction_tables[0] is None:
+        if not self.accounts:
             return
 
-        transactions = pd.concat(transaction_tables)
-        transactions['datetime'] = pd.to_datetime(transactions.index)
-
-        column_list = ['datetime', 'amount',
-                       'transferringAccount_id', 'transferringAccountName', 'transferringAccountType',
-                       'acquiringAccount_id', 'acquiringAccountName', 'acquiringAccountType',
-                       'transactionTypeMain', 'transactionTypeSupplementary', 'unitType']
+        start, end = self.period
+        account_ids = tuple(sorted(account.id for account in self.accounts))
+        transactions = query_transactions(account_ids, start, end)
 
-        if not set(column_list).issubset(transactions.columns):
-            warnings.warn('At least one of the required columns is missing from the transaction table. Investigate!')
+        if transactions.empty:
             return
 
-        transactions = transactions[column_list].copy()
+        # the cached table is shared between calls, work on a copy
+        transactions = transactions.copy()
 
-        if self.entity_type == EntityType.Account:
+        if self.entity_type is EntityType.Account:
             # rename AccountHolder -> Entity
             for side in self.sides:
                 transactions.rename(columns={f'{side}Account_id': f'{side}Entity_id',
                                              f'{side}AccountName': f'{side}Entity_name',
                                              f'{side}AccountType': f'{side}Entity_type'}, inplace=True)
-        elif self.entity_type == EntityType.AccountHolder:
+        elif self.entity_type is EntityType.AccountHolder:
             # map each (transferring or acquiring) account to its account holder
+            account_to_accountHolder = get_account_to_accountHolder()
             for side in self.sides:
-                account_to_accountHolder_temp = account_to_accountHolder.copy()
-                account_to_accountHolder_temp.rename(columns={"accountHolder_id": f"{side}AccountHolder_id",
-                                                              "accountHolder_name": f"{side}AccountHolder_name"},
-                                                     inplace=True)
-                # merge transaction table with dataframe containing account holder information for each account
-                # -> merge on account id (for each side separately)
-                #
-                transactions = transactions.merge(account_to_accountHolder_temp,
-                                                  how="left",
-                                                  left_on=[f"{side}Account_id"],
-                                                  right_on=["account_id"],
-                                                  indicator=f"{side}_mapped"
-                                                  )
-
-                assert (transactions[f"{side}_mapped"] == "both").all(), f"Not all {side} accounts could be mapped to" \
-                                                                         f"their account holder."
+                for field in ["id", "name"]:
+                    transactions[f"{side}AccountHolder_{field}"] = transactions[f"{side}Account_id"].map(
+                        account_to_accountHolder[f"accountHolder_{field}"])
+
+                assert transactions[f"{side}AccountHolder_id"].notna().all(), f"Not all {side} accounts could be " \
+                                                                              f"mapped to their account holder."
                 # TODO: does this case ever happen ? If yes, what do we want to do ?
 
             # discard internal transactions between accounts of the same account holder
@@ -157,20 +224,34 @@ class EntityConnexion:
             for side in self.sides:
                 transactions[f"{side}Entity_type"] = np.nan
 
-        elif self.entity_type == 'Company':
+        elif self.entity_type is EntityType.Company:
             # todo: merge with account get company_id > merger with accountHolder (transferring and acquiring)
             #  then rename columns
             pass
 
+        # Sometimes there are missing values in the transaction dataframe (entity columns are not set for Company yet)
+        entity_id_columns = [f'{side}Entity_id' for side in self.sides]
+        if set(entity_id_columns).issubset(transactions.columns) and transactions[entity_id_columns].isna().values.any():
+            warnings.warn('  Some Entity IDs missing ... replacing by -1/unknown')
+            fillval = {}
+            for side in self.sides:
+                fillval.update({f'{side}Entity_id': -1, f'{side}Entity_name': 'unknown', f'{side}Entity_type': 'unknown'})
+            # names and types are categorical, go back to plain objects so that 'unknown' can be filled in
+            transactions = transactions.astype({f'{side}Entity_{field}': object
+                                                for side in self.sides for field in ['name', 'type']})
+            transactions.fillna(value=fillval, inplace=True)
+
         # todo: add an option to remove "admin" transactions
 
         self.transactions = transactions
 
         print('  > Found {} transactions\n'.format(len(self.transactions)))
-        # todo: add the period condition here
 
     def plot_arrows(self, keep_interactive_plot=False):
         """Plot transaction graph and save it as png file."""
+        # matplotlib is only imported when plotting, so that the transaction analysis does not pay for it
+        import matplotlib.patches as mpatches
+        import matplotlib.pyplot as plt
 
         # todo: add selected dates on graph
 
@@ -180,26 +261,25 @@ class EntityConnexion:
         transaction_table = self.transactions
         this_node = self.entity_id
 
-        # Sometimes there are missing values in the transaction dataframe
-        for side in self.sides:
-            if transaction_table[f'{side}Entity_id'].isnull().any():
-                warnings.warn(f'  Some {side}Entity IDs missing ... replacing by -1/unknown')
-                fillval = {'transferringEntity_id': -1,
-                           'transferringEntity_name': 'unknown', 'transferringEntity_type': 'unknown'}
-                transaction_table.fillna(value=fillval, inplace=True)
-
         # Make graph from transactions dataframe
-        transaction_graph = nx.from_pandas_edgelist(transaction_table, source='transferringEntity_id', target='acquiringEntity_id',
-                                                    edge_attr='amount', create_using=nx.DiGraph())
+        transaction_graph = nx.DiGraph()
+        transaction_graph.add_weighted_edges_from(zip(transaction_table['transferringEntity_id'].to_numpy(),
+                                                      transaction_table['acquiringEntity_id'].to_numpy(),
+                                                      transaction_table['amount'].to_numpy()),
+                                                  weight='amount')
         if len(transaction_graph) > 40:  # if too many nodes, no point in plotting
             warnings.warn('Too many nodes, not producing graph')
             warnings.warn('Too many nodes, not producing graph')
             return
 
         # determine receiver/sender/trader status
-        attrs = {}
         trans_entities = set(transaction_table['transferringEntity_id'])
         acqui_entities = set(transaction_table['acquiringEntity_id'])
+        trader_type = dict.fromkeys(trans_entities - acqui_entities, 'sender')
+        trader_type.update(dict.fromkeys(acqui_entities - trans_entities, 'receiver'))
+        trader_type.update(dict.fromkeys(trans_entities & acqui_entities, 'trader'))
+        if this_node in trader_type:
+            trader_type[this_node] = 'this'
 
         # colors
         color_legend = {'this': 'green', 'trader': 'violet', 'sender': 'blue', 'receiver': 'red'}
@@ -208,37 +288,28 @@ class EntityConnexion:
             color_handles.append(mpatches.Patch(color=color_legend[c], label=c))
 
         entity_id_to_name = self.create_entity_information_table(transaction_table)
+        entity_names = entity_id_to_name["entity_name"].to_dict()
+        entity_types = entity_id_to_name["entity_type"].to_dict()
 
-        # loop over nodes
-        for node in transaction_graph:
-            attrs[node] = {}
-            # todo: change color based on account type not on trader_type
-            attrs[node]['name'] = entity_id_to_name.loc[node, "entity_name"]
-            attrs[node]['id'] = node
-            attrs[node]['type'] = entity_id_to_name.loc[node, "entity_type"]
-            if (node in trans_entities) and (node in acqui_entities):
-                attrs[node]['trader_type'] = 'trader'
-                attrs[node]['color'] = color_legend[attrs[node]['trader_type']]
-            elif node in trans_entities:
-                attrs[node]['trader_type'] = 'sender'
-                attrs[node]['color'] = color_legend[attrs[node]['trader_type']]
-            elif node in acqui_entities:
-                attrs[node]['trader_type'] = 'receiver'
-                attrs[node]['color'] = color_legend[attrs[node]['trader_type']]
-            if node == this_node:  # just changing the trader type and color (name and type should have been set before)
-                attrs[node]['trader_type'] = 'this'
-                attrs[node]['color'] = color_legend[attrs[node]['trader_type']]
+        # todo: change color based on account type not on trader_type
+        attrs = {node: {'name': entity_names[node],
+                        'id': node,
+                        'type': entity_types[node],
+                        'trader_type': trader_type[node],
+                        'color': color_legend[trader_type[node]]}
+                 for node in transaction_graph}
 
         nx.set_node_attributes(transaction_graph, attrs)
 
         # defining width of arrows
         width_thinnest_edge = 0.05
         width_thickest_edge = 3
-        max_width = max([transaction_graph[u][v]['amount'] for u, v in transaction_graph.edges])
-        width = [width_thickest_edge * transaction_graph[u][v]['amount'] / max_width + width_thinnest_edge for u, v in transaction_graph.edges()]
+        amounts = np.fromiter((amount for _, _, amount in transaction_graph.edges(data='amount')),
+                              dtype=np.float64, count=transaction_graph.number_of_edges())
+        width = width_thickest_edge / amounts.max() * amounts + width_thinnest_edge
 
         # get list of nodes and reorder based on trader type
-        list_of_nodes = [x for _, x in sorted(zip([attrs[n]['trader_type'] for n in transaction_graph], transaction_graph))]
+        list_of_nodes = sorted(transaction_graph, key=lambda n: attrs[n]['trader_type'])
         list_of_nodes.remove(this_node)
 
         # define circular position
@@ -246,9 +317,8 @@ class EntityConnexion:
         pos[this_node] = np.array([0, 0])
 
         # define label positions (slightly below node)
-        pos_attrs = {}
-        for node, coords in pos.items():
-            pos_attrs[node] = (coords[0], coords[1] - .25)
+        label_coords = np.vstack(list(pos.values())) - np.array([0, .25])
+        pos_attrs = dict(zip(pos.keys(), map(tuple, label_coords)))
 
         # plot the whole thing
         fig, ax = plt.subplots(figsize=(10, 7))
@@ -257,13 +327,13 @@ class EntityConnexion:
                 with_labels=False, width=width)
         nx.draw_networkx_labels(transaction_graph, pos_attrs, labels={n: f"{attrs[n]['name']} \n({attrs[n]['id']})" for n in attrs})
         ax.legend(handles=color_handles)
-        if self.entity_type == 'Company':
-            plt.title(f'ETS trading connections for {self.entity_type}: {self.entity_id}')
+        if self.entity_type is EntityType.Company:
+            plt.title(f'ETS trading connections for {self.entity_type.value}: {self.entity_id}')
         else:
-            plt.title(f'ETS trading connections for {self.entity_type}: {self.entity_name}')
+            plt.title(f'ETS trading connections for {self.entity_type.value}: {self.entity_name}')
         plt.tight_layout()
 
-        full_path_plot = paths.path_plots / f'arrows_{self.entity_type}_{self.entity_id}.png'
+        full_path_plot = paths.path_plots / f'arrows_{self.entity_type.value}_{self.entity_id}.png'
         plt.savefig(full_path_plot, dpi=500)
         print(f"Transaction graph plot saved under: {full_path_plot}")
 
@@ -277,13 +347,13 @@ class EntityConnexion:
         """
         mapping = []
         for side in self.sides:
-            mapping_side = transaction_table[[f"{side}Entity_id", f"{side}Entity_name", f"{side}Entity_type"]].copy()
-            mapping_side.rename(columns={f"{side}Entity_id": "entity_id",
-                                         f"{side}Entity_name": "entity_name",
-                                         f"{side}Entity_type": "entity_type"}, inplace=True)
+            mapping_side = transaction_table[[f"{side}Entity_id", f"{side}Entity_name", f"{side}Entity_type"]]
+            mapping_side = mapping_side.rename(columns={f"{side}Entity_id": "entity_id",
+                                                        f"{side}Entity_name": "entity_name",
+                                                        f"{side}Entity_type": "entity_type"}, copy=False)
             mapping.append(mapping_side)
-        mapping = pd.concat(mapping).drop_duplicates()
-        mapping = mapping.set_index("entity_id").sort_index()
+        mapping = pd.concat(mapping, copy=False, ignore_index=True, sort=False)
+        mapping = mapping.groupby("entity_id", sort=True).first()
         return mapping
 
     def plot_cumul(self):
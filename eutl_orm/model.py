@@ -1,7 +1,7 @@
 from datetime import datetime
 
 from sqlalchemy import (Integer, Float, Column, String, ForeignKey, Boolean, DateTime,
-                        BigInteger)
+                        BigInteger, Index)
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship, backref
 import pandas as pd 
@@ -25,6 +25,8 @@ def format_address(x):
 class Transaction(Base):
     """ Transaction blocks """
     __tablename__ = "transaction"
+    __table_args__ = (Index("ix_transaction_transferringAccount_id_date", "transferringAccount_id", "date"),
+                      Index("ix_transaction_acquiringAccount_id_date", "acquiringAccount_id", "date"))
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     transactionID = Column(String(100))
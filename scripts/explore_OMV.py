@@ -9,9 +9,11 @@ import matplotlib.pyplot as plt
 from tqdm import tqdm
 import seaborn as sns
 import datetime as dt
+from sqlalchemy import or_
+from sqlalchemy.orm import aliased
 
 from eutl_orm import DataAccessLayer
-from eutl_orm import Installation, Account
+from eutl_orm import Installation, Account, Transaction, TransactionTypeMain, TransactionTypeSupplementary
 from attic import paths
 from attic.connection_settings import connectionSettings
 
@@ -65,30 +67,50 @@ acc_ids = [a.id for a in accounts]
 # Get all transactions
 # ---------------------------------------------------------------------------------------------------
 
-transaction_tables = []
-for account in accounts:
-    transaction_tables.append(account.get_transactions())
-
-transactions = pd.concat(transaction_tables)
+# fetch the transactions of all accounts in a single query instead of one query per account
+transferringAccount = aliased(Account)
+acquiringAccount = aliased(Account)
+transaction_query = session.query(Transaction.transactionID, Transaction.date, Transaction.amount,
+                                  Transaction.transferringAccount_id,
+                                  transferringAccount.name.label("transferringAccountName"),
+                                  Transaction.acquiringAccount_id,
+                                  acquiringAccount.name.label("acquiringAccountName"),
+                                  TransactionTypeMain.description.label("transactionTypeMain"),
+                                  TransactionTypeSupplementary.description.label("transactionTypeSupplementary"))\
+    .outerjoin(transferringAccount, Transaction.transferringAccount_id == transferringAccount.id)\
+    .outerjoin(acquiringAccount, Transaction.acquiringAccount_id == acquiringAccount.id)\
+    .outerjoin(TransactionTypeMain, Transaction.transactionTypeMain_id == TransactionTypeMain.id)\
+    .outerjoin(TransactionTypeSupplementary,
+               Transaction.transactionTypeSupplementary_id == TransactionTypeSupplementary.id)\
+    .filter(or_(Transaction.transferringAccount_id.in_(acc_ids), Transaction.acquiringAccount_id.in_(acc_ids)))
+transactions = pd.read_sql(transaction_query.statement, con=session.connection(), parse_dates=["date"])\
+    .set_index("date").sort_index()
+
+# amount_directed > 0 : allowances are transferred TO the account holder, < 0 : FROM the account holder
+# (transfers between two of its own accounts cancel out)
+transactions["amount_directed"] = transactions["amount"] * (transactions["acquiringAccount_id"].isin(acc_ids).astype(int)
+                                                            - transactions["transferringAccount_id"].isin(acc_ids).astype(int))
 
 # add date and datetime information to table (to price transactions with daily ETS price)
-transactions["date"] = pd.to_datetime(transactions.index.date)
 transactions["datetime"] = pd.to_datetime(transactions.index)
-
-# aggregate transaction blocks into individual transactions
-aggregated_transactions = transactions.groupby("transactionID").agg({"amount": "sum", "amount_directed": "sum",
-                                                                     "transferringAccount_id": "first",
-                                                                     "acquiringAccount_id": "first",
-                                                                     "date": "first",
-                                                                     "datetime": "first",
-                                                                     "acquiringAccountName": "first",
-                                                                     "transferringAccountName": "first",
-                                                                     "transactionTypeMain": "first",
-                                                                     "transactionTypeSupplementary": "first"})
+transactions["date"] = transactions["datetime"].dt.floor("D")
+
+# aggregate transaction blocks into individual transactions: sort the blocks by transaction id, then sum the amounts
+# and keep the first value of the other columns over each run of identical ids
+transactions = transactions.sort_values("transactionID", kind="stable")
+transaction_ids = transactions["transactionID"].to_numpy()
+starts = np.flatnonzero(np.concatenate(([True], transaction_ids[1:] != transaction_ids[:-1])))
+aggregated_transactions = transactions.iloc[starts].set_index("transactionID")[
+    ["amount", "amount_directed", "transferringAccount_id", "acquiringAccount_id", "date", "datetime",
+     "acquiringAccountName", "transferringAccountName", "transactionTypeMain", "transactionTypeSupplementary"]]
+aggregated_transactions = aggregated_transactions.assign(
+    amount=np.add.reduceat(transactions["amount"].to_numpy(), starts),
+    amount_directed=np.add.reduceat(transactions["amount_directed"].to_numpy(), starts))
 
 # map all Accounts to their Account Holder
 #print('Getting list of account and accountHolder IDs')
-account_to_account_holder = pd.DataFrame(session.query(Account.id, Account.accountHolder_id).all())
+account_to_account_holder_query = session.query(Account.id, Account.accountHolder_id)
+account_to_account_holder = pd.read_sql(account_to_account_holder_query.statement, con=session.connection())
 n_accounts = len(account_to_account_holder)
 #print(n_accounts, 'found')
 account_to_account_holder.columns = ['id', 'accountHolder_id']
@@ -102,10 +124,8 @@ mapping_tmp = mapping_tmp.rename(columns={"id": "acquiringAccount_id",
                                           "accountHolder_id": "acquiringAccountHolder_id"})
 
 #print('merging acquiring account')
-aggregated_transactions = aggregated_transactions.merge(mapping_tmp, how="left", on="acquiringAccount_id", indicator=True)
-stat = aggregated_transactions.groupby('_merge')['acquiringAccount_id'].count()
-#print(stat)
-aggregated_transactions = aggregated_transactions.drop(columns=['_merge'])
+#print((~aggregated_transactions["acquiringAccount_id"].isin(mapping_tmp["acquiringAccount_id"])).sum(), 'not mapped')
+aggregated_transactions = aggregated_transactions.merge(mapping_tmp, how="left", on="acquiringAccount_id")
 
 # temporary mapping for the Transferring Account
 mapping_tmp = account_to_account_holder.copy()
@@ -113,10 +133,8 @@ mapping_tmp = mapping_tmp.rename(columns={"id": "transferringAccount_id",
                                           "accountHolder_id": "transferringAccountHolder_id"})
 
 #print('merging acquiring account')
-aggregated_transactions = aggregated_transactions.merge(mapping_tmp, how="left", on="transferringAccount_id", indicator=True)
-stat = aggregated_transactions.groupby('_merge')['acquiringAccount_id'].count()
-#print(stat)
-aggregated_transactions = aggregated_transactions.drop(columns=['_merge'])
+#print((~aggregated_transactions["transferringAccount_id"].isin(mapping_tmp["transferringAccount_id"])).sum(), 'not mapped')
+aggregated_transactions = aggregated_transactions.merge(mapping_tmp, how="left", on="transferringAccount_id")
 
 # drop all transactions internal to an Account Holder
 internal_transactions_sel = aggregated_transactions.acquiringAccountHolder_id == aggregated_transactions.transferringAccountHolder_id
@@ -145,10 +163,8 @@ plt.close()
 # Price the transactions
 # ---------------------------------------------------------------------------------------------------
 
-aggregated_transactions = aggregated_transactions.merge(prices, how='left', on="date", indicator=True)
-stat = aggregated_transactions.groupby('_merge')['acquiringAccount_id'].count()
-#print(stat)
-aggregated_transactions = aggregated_transactions.drop(columns=['_merge'])
+#print((~aggregated_transactions["date"].isin(prices["date"])).sum(), 'without price')
+aggregated_transactions = aggregated_transactions.merge(prices, how='left', on="date")
 
 eu_allocation_account_id = session.query(Account).filter(Account.name == "EU EU ALLOCATION ACCOUNT").first().id
 eu_deletion_account_id = session.query(Account).filter(Account.name == "EU EU Allowance deletion").first().id